@@ -1,6 +1,5 @@
-from functools import partial
 import numpy as np
-from scipy.stats import spearmanr
+from scipy.stats import rankdata
 from sklearn.metrics import (
     f1_score,
     precision_score,
@@ -11,8 +10,6 @@ from sklearn.metrics import (
     hamming_loss,
 )
 
-from csrank.numpy_util import scores_to_rankings
-
 __all__ = [
     "spearman_correlation_for_scores_np",
     "kendalls_tau_for_scores_np",
@@ -35,28 +32,70 @@ __all__ = [
 ]
 
 
+def _ordering_of_ranking(y):
+    """Orderings of the rows of ``y``, if all of them are rankings.
+
+    The true rankings are usually permutations of ``0, ..., n_objects - 1``.
+    Their orderings are the inverse permutations, which only need a scatter
+    instead of a sort. Returns ``None`` if a row is not such a permutation.
+    """
+    n_instances, n_objects = y.shape
+    if not np.issubdtype(y.dtype, np.integer) or y.size == 0:
+        return None
+    if y.min() < 0 or y.max() >= n_objects:
+        return None
+    ordering = np.full(y.shape, -1, dtype=np.intp)
+    ordering[np.arange(n_instances)[:, None], y] = np.arange(n_objects)
+    # A repeated rank leaves another position unassigned
+    if np.any(ordering < 0):
+        return None
+    return ordering
+
+
+def _pred_order(s_pred):
+    """The predicted orderings, i.e. the objects sorted by decreasing score.
+
+    Metrics which only depend on the order of the predictions use this
+    instead of `scores_to_rankings`, which checks all pairs of scores for
+    ties and inverts the ordering.
+    """
+    return np.argsort(-s_pred, axis=1, kind="stable")
+
+
 def spearman_correlation_for_scores_np(y_true, s_pred):
-    y_pred = scores_to_rankings(s_pred)
-    rho = []
-    n_objects = y_true.shape[1]
+    n_instances, n_objects = y_true.shape
+    rows = np.arange(n_instances)[:, None]
     denominator = n_objects * (n_objects ** 2 - 1)
 
-    for r1, r2 in zip(y_true, y_pred):
-        if len(np.unique(r2)) == len(r2):
-            s = 1 - (6 * np.sum((r1 - r2) ** 2) / denominator)
-            rho.append(s)
-        else:
-            rho.append(np.nan)
-    return np.nanmean(np.array(rho))
+    # Without ties the predicted ranking is the inverse of the ordering
+    order = _pred_order(s_pred)
+    y_pred = np.empty_like(order)
+    y_pred[rows, order] = np.arange(n_objects)
+
+    diff = (y_true - y_pred).astype(float)
+    rho = 1.0 - 6.0 * np.einsum("ij,ij->i", diff, diff) / denominator
+
+    # The closed form is only valid for rankings without ties
+    sorted_scores = s_pred[rows, order]
+    ties = (sorted_scores[:, 1:] == sorted_scores[:, :-1]).any(axis=1)
+    return np.nanmean(np.where(ties, np.nan, rho))
 
 
 def spearman_correlation_for_scores_scipy(y_true, s_pred):
-    y_pred = scores_to_rankings(s_pred)
-    rho = []
-    for r1, r2 in zip(y_true, y_pred):
-        s = spearmanr(r1, r2)[0]
-        rho.append(s)
-    return np.nanmean(np.array(rho))
+    # Spearman's rho is the Pearson correlation of the (average) ranks. The
+    # ranks of the predicted ranking are the ranks of the negated scores.
+    if _ordering_of_ranking(y_true) is not None:
+        r1 = y_true + 1.0
+    else:
+        r1 = rankdata(y_true, axis=1)
+    r2 = rankdata(-s_pred, axis=1)
+    r1 -= r1.mean(axis=1, keepdims=True)
+    r2 -= r2.mean(axis=1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rho = np.sum(r1 * r2, axis=1) / np.sqrt(
+            np.sum(r1 * r1, axis=1) * np.sum(r2 * r2, axis=1)
+        )
+    return np.nanmean(rho)
 
 
 def kendalls_tau_for_scores_np(y_true, s_pred):
@@ -64,50 +103,210 @@ def kendalls_tau_for_scores_np(y_true, s_pred):
 
 
 def zero_one_accuracy_for_scores_np(y_true, s_pred):
-    y_pred = scores_to_rankings(s_pred)
-    acc = np.sum(np.all(np.equal(y_true, y_pred), axis=1)) / y_pred.shape[0]
+    rows = np.arange(s_pred.shape[0])[:, None]
+    order = _pred_order(s_pred)
+    sorted_scores = s_pred[rows, order]
+    if np.any(sorted_scores[:, 1:] == sorted_scores[:, :-1]):
+        # Tied objects share their average rank
+        y_pred = s_pred.shape[1] - rankdata(s_pred, axis=1)
+        return zero_one_accuracy_np(y_true, y_pred)
+    # Without ties the predicted ranking is the inverse of the ordering, so
+    # the true ranks read in predicted order have to be 0, 1, ..., n - 1.
+    correct = np.all(y_true[rows, order] == np.arange(s_pred.shape[1]), axis=1)
+    acc = np.sum(correct) / s_pred.shape[0]
     return acc
 
 
 def zero_one_accuracy_np(y_true, y_pred):
-    acc = np.sum(np.all(np.equal(y_true, y_pred), axis=1)) / y_pred.shape[0]
+    n_instances = y_pred.shape[0]
+    # Reduce the comparison to one flag per instance right away
+    n_wrong = np.count_nonzero(np.any(y_true != y_pred, axis=1))
+    acc = (n_instances - n_wrong) / n_instances
     return acc
 
 
-def make_ndcg_at_k_loss_np(k=5):
+def _top_k_indices(values, k):
+    """Indices of the ``k`` largest entries of every row, largest first.
+
+    Only the top ``k`` entries are selected with ``np.argpartition`` and
+    then sorted, which avoids sorting the full rows.
+    """
+    rows = np.arange(values.shape[0])[:, None]
+    top = np.argpartition(-values, k - 1, axis=1)[:, :k]
+    order = np.argsort(-values[rows, top], axis=1)
+    return top[rows, order]
+
+
+def _tie_averaged_dcg(relevance, y_pred, discount):
+    """DCG of the predicted rankings, averaged over the orders of ties.
+
+    Objects which share a predicted rank share the sum of the discounts of
+    the positions they occupy, weighted by their mean relevance. This is
+    the expected DCG over all orders of the tied objects, the same
+    definition ``sklearn.metrics.ndcg_score`` uses by default.
+    """
+    n_instances, n_objects = y_pred.shape
+    rows = np.arange(n_instances)[:, None]
+    order = np.argsort(y_pred, axis=1, kind="stable")
+    sorted_pred = y_pred[rows, order]
+    new_group = np.ones_like(sorted_pred, dtype=bool)
+    new_group[:, 1:] = sorted_pred[:, 1:] != sorted_pred[:, :-1]
+
+    # Reduce the groups of all instances at once on the flattened arrays
+    starts = np.flatnonzero(new_group)
+    group_relevance = np.add.reduceat(relevance[rows, order].ravel(), starts)
+    group_discount = np.add.reduceat(np.tile(discount, n_instances), starts)
+    group_size = np.diff(np.append(starts, n_instances * n_objects))
+    return np.bincount(
+        starts // n_objects,
+        weights=group_relevance * group_discount / group_size,
+        minlength=n_instances,
+    )
+
+
+def _relevance_gain_ndcg(y, n_objects):
+    """The relevance of the ranks ``y`` as defined for the NDCG metric."""
+    return np.expm1(np.log(2.0) * (n_objects - y) * 60.0 / n_objects).astype(np.float32)
+
+
+def make_ndcg_at_k_loss_np(k=5, ignore_ties=True):
+    """Plain numpy version of `make_ndcg_at_k_loss`, see the documentation
+    of that function for details.
+
+    Parameters
+    ----------
+    k: int
+        The length of the ranking for evaluation purposes.
+    ignore_ties: bool
+        If True (the default), the top k predictions are selected directly,
+        breaking ties arbitrarily. This is faster and exact as long as the
+        predicted ranking contains no ties. If False, the gain of tied
+        predictions is averaged over all of their possible orders.
+    """
+    inv_log_term = (1.0 / np.log2(np.arange(k) + 2.0)).astype(np.float32)
+    # Relevance lookup tables by the number of objects, see below
+    gain_luts = {}
+
     def ndcg(y_true, y_pred):
+        y_true = np.asarray(y_true, order="C")
+        y_pred = np.asarray(y_pred, order="C")
         n_instances, n_objects = y_true.shape
-        relevance = np.power(2.0, ((n_objects - y_true) * 60) / n_objects) - 1.0
-        relevance_pred = np.power(2.0, ((n_objects - y_pred) * 60) / n_objects) - 1.0
-
-        log_term = np.log(np.arange(k, dtype="float32") + 2.0) / np.log(2.0)
+        rows = np.arange(n_instances)[:, None]
+        k_objects = min(k, n_objects)
+
+        # If the rankings are integers from 0 to n_objects, the relevance of
+        # every possible rank can be looked up instead of being exponentiated
+        # for every element. The table only depends on the number of objects
+        # and is kept across calls. Other rankings use the closed form.
+        if (
+            np.issubdtype(y_true.dtype, np.integer)
+            and y_true.size > 0
+            and y_true.min() >= 0
+            and y_true.max() <= n_objects
+        ):
+            if n_objects not in gain_luts:
+                gain_luts[n_objects] = _relevance_gain_ndcg(
+                    np.arange(n_objects + 1), n_objects
+                )
+            relevance = gain_luts[n_objects][y_true]
+        else:
+            relevance = _relevance_gain_ndcg(y_true, n_objects)
 
-        # Calculate ideal dcg:
-        top_t = np.argsort(relevance, axis=1)[:, ::-1][:, :k]
-        toprel = relevance[np.arange(n_instances)[:, None], top_t]
-        idcg = np.sum(toprel / log_term, axis=-1, keepdims=True)
+        # Calculate ideal dcg (the relevance decreases with the rank, so the
+        # most relevant objects are the ones with the lowest ranks):
+        top_t = _ordering_of_ranking(y_true)
+        if top_t is None:
+            top_t = _top_k_indices(-y_true, k_objects)
+        else:
+            top_t = top_t[:, :k_objects]
+        idcg = relevance[rows, top_t] @ inv_log_term[:k_objects]
 
         # Calculate actual dcg:
-        top_p = np.argsort(relevance_pred, axis=1)[:, ::-1][:, :k]
-        pred_rel = relevance[np.arange(n_instances)[:, None], top_p]
-        pred_rel = np.sum(pred_rel / log_term, axis=-1, keepdims=True)
-        gain = pred_rel / idcg
+        if ignore_ties:
+            top_p = _top_k_indices(-y_pred, k_objects)
+            dcg = relevance[rows, top_p] @ inv_log_term[:k_objects]
+        else:
+            discount = np.zeros(n_objects, dtype=np.float32)
+            discount[:k_objects] = inv_log_term[:k_objects]
+            dcg = _tie_averaged_dcg(relevance, y_pred, discount)
+        gain = dcg / idcg
         return gain
 
     return ndcg
 
 
-def zero_one_rank_loss_for_scores_ties_np(y_true, s_pred):
-    n_objects = y_true.shape[1]
-    mask = np.greater(y_true[:, None] - y_true[:, :, None], 0).astype(float)
-    mask2 = np.greater(s_pred[:, None] - s_pred[:, :, None], 0).astype(float)
-    mask3 = np.equal(s_pred[:, None] - s_pred[:, :, None], 0).astype(float)
+def _count_ascending_pairs(a):
+    """Count the pairs ``p < q`` with ``a[:, p] < a[:, q]`` in every row.
+
+    This is a bottom-up merge sort over all rows at once: At every level
+    adjacent blocks are merged and each element of the right block counts
+    the elements of the left block which are strictly smaller. The rows of
+    ``a`` have to consist of non-negative integers.
+    """
+    n_instances, n_objects = a.shape
+    width = 1
+    while width < n_objects:
+        width *= 2
+    # 32 bit keys halve the memory traffic of the sorts for all practical
+    # numbers of objects (the tagged keys below need one more bit).
+    dtype = np.int32 if 2 * width < np.iinfo(np.int32).max else np.int64
+    # Pad to a power of two. The padding is smaller than every entry and
+    # only ever ends up in left blocks which are followed by more padding.
+    keys = np.full((n_instances, width), -1, dtype=dtype)
+    keys[:, :n_objects] = a
+    counts = np.zeros(n_instances, dtype=np.int64)
+    block = 1
+    while block < width:
+        # Tag elements of the left block in the lowest bit, so that ties are
+        # sorted right before left and do not count as ascending.
+        keys = keys.reshape(n_instances, -1, 2, block) * 2
+        keys[:, :, 0] += 1
+        # Both halves are already sorted, which the stable sort exploits by
+        # merging the two runs in linear time.
+        keys = np.sort(keys.reshape(n_instances, -1, 2 * block), axis=-1, kind="stable")
+        # The number of left elements before a right element is its position
+        # minus its rank among the right elements. Summed over the block this
+        # is the sum of the right positions minus 0 + 1 + ... + (block - 1).
+        left_positions = np.sum(
+            (keys & 1) * np.arange(2 * block), axis=(1, 2), dtype=np.int64
+        )
+        n_blocks = keys.shape[1]
+        right_positions = n_blocks * block * (2 * block - 1) - left_positions
+        counts += right_positions - n_blocks * block * (block - 1) // 2
+        keys = (keys >> 1).reshape(n_instances, width)
+        block *= 2
+    return counts
+
 
-    # Calculate Transpositions
-    transpositions = np.logical_and(mask, mask2)
-    x = (np.sum(mask3, axis=(1, 2)) - n_objects).astype(float) / 4.0
-    transpositions = np.sum(transpositions, axis=(1, 2)).astype(float)
-    transpositions += x
+def zero_one_rank_loss_for_scores_ties_np(y_true, s_pred):
+    # The scores keep their precision, since rounding could introduce ties
+    y_true = np.asarray(y_true, order="C")
+    s_pred = np.asarray(s_pred, order="C")
+    n_instances, n_objects = y_true.shape
+    rows = np.arange(n_instances)[:, None]
+
+    # Replace the scores by dense integer ranks, starting with 0 for the
+    # highest score. Tied scores share a rank.
+    order = _pred_order(s_pred)
+    sorted_scores = s_pred[rows, order]
+    new_value = np.ones_like(sorted_scores, dtype=bool)
+    new_value[:, 1:] = sorted_scores[:, 1:] != sorted_scores[:, :-1]
+    dense = np.empty_like(order)
+    dense[rows, order] = np.cumsum(new_value, axis=1) - 1
+
+    # Every tied pair of scores counts as half a transposition
+    positions = np.broadcast_to(np.arange(n_objects), order.shape)
+    run_start = np.maximum.accumulate(np.where(new_value, positions, 0), axis=1)
+    ties = np.sum(positions - run_start, axis=1)
+
+    # Order the objects by their true rank. Within objects of equal true
+    # rank the scores are descending, so that they form no transposition.
+    true_order = _ordering_of_ranking(y_true)
+    if true_order is None:
+        true_order = np.lexsort((dense, y_true), axis=1)
+    # A transposition is a pair whose later object has the higher score
+    transpositions = _count_ascending_pairs(n_objects - 1 - dense[rows, true_order])
+    transpositions = transpositions + ties / 2.0
 
     denominator = n_objects * (n_objects - 1.0) / 2.0
     result = transpositions / denominator
@@ -119,19 +318,14 @@ def zero_one_rank_loss_for_scores_np(y_true, s_pred):
 
 
 def auc_score(y_true, s_pred):
-    idx = np.where(
-        (y_true.sum(axis=1) != y_true.shape[-1] - 1)
-        & (y_true.sum(axis=1) != y_true.shape[-1])
-        & (y_true.sum(axis=1) != 1)
-        & (y_true.sum(axis=1) != 0)
-    )[0]
-    if len(idx) > 1:
-        auc = roc_auc_score(y_true[idx], s_pred[idx], average="samples")
-    elif len(idx) == 1:
-        auc = roc_auc_score(y_true[idx][0], s_pred[idx][0])
-    else:
-        auc = np.nan
-    return auc
+    # Only keep instances with at least two chosen and two rejected objects
+    n_chosen = y_true.sum(axis=1)
+    n_objects = y_true.shape[-1]
+    idx = np.where((n_chosen > 1) & (n_chosen < n_objects - 1))[0]
+    if len(idx) == 0:
+        return np.nan
+    # A single instance stays two-dimensional, its auc is the sample average
+    return roc_auc_score(y_true[idx], s_pred[idx], average="samples")
 
 
 def average_precision(y_true, s_pred):
@@ -139,10 +333,14 @@ def average_precision(y_true, s_pred):
 
 
 def instance_informedness(y_true, y_pred):
-    tp = np.logical_and(y_true, y_pred).sum(axis=1)
-    tn = np.logical_and(np.logical_not(y_true), np.logical_not(y_pred)).sum(axis=1)
-    cp = y_true.sum(axis=1)
-    cn = np.logical_not(y_true).sum(axis=1)
+    n_objects = np.shape(y_true)[1]
+    # Bitwise operations on bytes avoid the temporaries of logical_not
+    y_true = np.asarray(y_true, dtype=bool).view(np.uint8)
+    y_pred = np.asarray(y_pred, dtype=bool).view(np.uint8)
+    tp = np.count_nonzero(y_true & y_pred, axis=1)
+    tn = n_objects - np.count_nonzero(y_true | y_pred, axis=1)
+    cp = np.count_nonzero(y_true, axis=1)
+    cn = n_objects - cp
     return np.nanmean(tp / cp + tn / cn - 1)
 
 
@@ -168,11 +366,11 @@ def hamming(y_true, y_pred):
 
 def topk_categorical_accuracy_np(k=5):
     def topk_acc(y_true, y_pred):
-        topK = y_pred.argsort(axis=1)[:, -k:][:, ::-1]
-        accuracies = np.zeros_like(y_true, dtype=bool)
+        # The order within the top k does not matter here
+        k_objects = min(k, y_pred.shape[1])
+        topK = np.argpartition(-y_pred, k_objects - 1, axis=1)[:, :k_objects]
         y_true = np.argmax(y_true, axis=1)
-        for i, top in enumerate(topK):
-            accuracies[i] = y_true[i] in top
+        accuracies = np.any(topK == y_true[:, None], axis=1)
         return np.mean(accuracies)
 
     return topk_acc
@@ -188,49 +386,57 @@ def categorical_accuracy_np(y_true, y_pred):
 def relevance_gain_np(grading, max_grade):
     """Plain python version of `relevance_gain`, see the documentation
     of that function for details."""
-    inverse_grading = -grading + max_grade
-    return (2 ** inverse_grading - 1) / (2 ** max_grade)
+    grading = np.asarray(grading, dtype=np.float32)
+    # (2 ** (max_grade - grading) - 1) / 2 ** max_grade, rearranged so that
+    # the powers cannot overflow for large grades
+    return np.exp2(-grading) - np.exp2(-np.float32(max_grade))
 
 
 def err_np(y_true, y_pred, utility_function=None, probability_mapping=None):
     """Plain python version of `err`, see the documentation of that
     function for details.
     """
-    if probability_mapping is None:
-        # assume y_true is a ranking, use relevance gain
-        max_grade = np.max(y_true)
-        probability_mapping = partial(relevance_gain_np, max_grade=max_grade)
     if utility_function is None:
         # reciprocal rank
         utility_function = lambda r: 1 / r
 
+    y_pred = np.asarray(y_pred, order="C")
     ninstances, nobjects = np.shape(y_pred)
 
-    satisfied_probs = np.reshape(
-        list(map(probability_mapping, y_true.flatten())), np.shape(y_true)
-    )
+    if probability_mapping is None:
+        # assume y_true is a ranking, use relevance gain (which works on
+        # whole arrays, so there is no need to map it over the elements)
+        y_true = np.asarray(y_true, dtype=np.float32, order="C")
+        satisfied_probs = relevance_gain_np(y_true, max_grade=np.max(y_true))
+    else:
+        # custom mappings get the original grades, which need not be floats
+        y_true = np.asarray(y_true)
+        satisfied_probs = np.reshape(
+            list(map(probability_mapping, y_true.flatten())), np.shape(y_true)
+        ).astype(np.float32)
 
     # sort satisfied probabilities according to the predicted ranking
     # black magic invocation to reorder each row
     row_indices = np.arange(ninstances).reshape(-1, 1)
     satisfied_at_rank = satisfied_probs[row_indices, y_pred]
 
-    # still not satisfied after having examined the first r ranks
-    not_yet_satisfied_at_rank = np.cumprod(1 - satisfied_at_rank, axis=1)
-
-    # append a column of 1s and drop the last column, since the
-    # probability the need has not been satisfied at the 0th rank is 1
-    not_yet_satisfied_at_rank = np.hstack(
-        (
-            np.ones(np.shape(not_yet_satisfied_at_rank)[0]).reshape(-1, 1),
-            not_yet_satisfied_at_rank,
-        )
-    )[:, :-1]
-
     # map over flattened array, then restore shape
-    utilities = list(map(utility_function, range(1, nobjects + 1)))
+    utilities = np.array(
+        list(map(utility_function, range(1, nobjects + 1))), dtype=np.float32
+    )
 
-    discount_at_rank = not_yet_satisfied_at_rank * utilities
-    discounted_document_values = satisfied_at_rank * discount_at_rank
-    results = np.sum(discounted_document_values, axis=1)
+    # still not satisfied after having examined the first r ranks, computed
+    # in place so that no further (ninstances, nobjects) arrays are needed
+    not_yet_satisfied_at_rank = 1 - satisfied_at_rank
+    np.cumprod(not_yet_satisfied_at_rank, axis=1, out=not_yet_satisfied_at_rank)
+
+    # the need is never satisfied before the first rank, so the remaining
+    # ranks are discounted by the probability after the previous rank
+    results = satisfied_at_rank[:, 0] * utilities[0]
+    results += np.einsum(
+        "ij,ij,j->i",
+        satisfied_at_rank[:, 1:],
+        not_yet_satisfied_at_rank[:, :-1],
+        utilities[1:],
+    )
     return np.average(results)
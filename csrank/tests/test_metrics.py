@@ -2,7 +2,7 @@ import numpy as np
 import pytest
 import itertools
 from keras import backend as K
-from numpy.testing import assert_almost_equal
+from numpy.testing import assert_almost_equal, assert_array_equal
 from functools import partial
 from pytest import approx
 
@@ -25,6 +25,8 @@ from csrank.metrics_np import (
     kendalls_tau_for_scores_np,
     zero_one_accuracy_for_scores_np,
     err_np,
+    make_ndcg_at_k_loss_np,
+    _ordering_of_ranking,
 )
 from csrank.numpy_util import ranking_ordering_conversion
 
@@ -93,6 +95,54 @@ def test_zero_one_rank_loss_for_scores(problem_for_scores):
         assert_almost_equal(actual=real_score, desired=np.array([0.1]))
 
 
+def brute_force_rank_loss(y_true, s_pred):
+    """Counts the transpositions pair by pair, tied scores count half."""
+    n_objects = y_true.shape[1]
+    losses = []
+    for ranking, scores in zip(y_true, s_pred):
+        transpositions = 0.0
+        for i, j in itertools.combinations(range(n_objects), 2):
+            if scores[i] == scores[j]:
+                transpositions += 0.5
+            elif (ranking[i] - ranking[j]) * (scores[i] - scores[j]) > 0:
+                transpositions += 1.0
+        losses.append(transpositions / (n_objects * (n_objects - 1) / 2))
+    return np.mean(losses)
+
+
+@pytest.mark.parametrize("n_objects", [2, 7, 16, 33])
+def test_zero_one_rank_loss_for_scores_ties_np_brute_force(n_objects):
+    random_state = np.random.RandomState(42)
+    n_instances = 10
+    rankings = np.array(
+        [random_state.permutation(n_objects) for _ in range(n_instances)]
+    )
+    # Rankings with tied (and not 0-based) ranks use the sorting fallback
+    tied_rankings = random_state.randint(1, 4, size=(n_instances, n_objects))
+    scores = random_state.rand(n_instances, n_objects)
+    tied_scores = np.round(scores * 3)
+
+    for y_true in [rankings, tied_rankings]:
+        for s_pred in [scores, tied_scores]:
+            assert zero_one_rank_loss_for_scores_ties_np(y_true, s_pred) == approx(
+                brute_force_rank_loss(y_true, s_pred)
+            )
+
+
+def test_ordering_of_ranking():
+    random_state = np.random.RandomState(42)
+    rankings = np.array([random_state.permutation(7) for _ in range(10)])
+    assert_array_equal(
+        _ordering_of_ranking(rankings), ranking_ordering_conversion(rankings)
+    )
+
+    # Anything that is not a permutation of 0, ..., n_objects - 1:
+    assert _ordering_of_ranking(np.array([[0, 1, 1, 3]])) is None
+    assert _ordering_of_ranking(np.array([[1, 2, 3, 4]])) is None
+    assert _ordering_of_ranking(np.array([[-1, 0, 1, 2]])) is None
+    assert _ordering_of_ranking(np.array([[0.0, 1.0, 2.0, 3.0]])) is None
+
+
 def test_zero_one_accuracy(problem_for_pred):
     y_true, y_pred, ties = problem_for_pred
 
@@ -138,6 +188,51 @@ def test_ndcg(problem_for_pred):
     assert_almost_equal(actual=real_gain, desired=expected_gain, decimal=5)
 
 
+def test_ndcg_np_ties():
+    y_true = np.arange(5)[None, :]
+    # Objects 1 and 2 are tied for the second position:
+    y_pred = np.array([[0, 1, 1, 2, 3]])
+
+    relevance = 2.0 ** ((5 - y_true[0]) * 60 / 5) - 1
+    idcg = relevance[0] / np.log2(2) + relevance[1] / np.log2(3)
+
+    # Ignoring ties, either of the tied objects is at the second position:
+    ndcg = make_ndcg_at_k_loss_np(k=2)
+    possible_gains = [
+        (relevance[0] / np.log2(2) + relevance[i] / np.log2(3)) / idcg for i in (1, 2)
+    ]
+    real_gain = ndcg(y_true, y_pred)
+    assert real_gain.shape == (1,)
+    assert real_gain[0] in [approx(gain, rel=1e-5) for gain in possible_gains]
+
+    # Otherwise, their relevance is averaged over both possible orders:
+    ndcg = make_ndcg_at_k_loss_np(k=2, ignore_ties=False)
+    expected_gain = np.mean(possible_gains)
+    assert ndcg(y_true, y_pred)[0] == approx(expected_gain, rel=1e-5)
+
+    # Both agree if there are no ties:
+    y_pred = np.array([[0, 2, 1, 3, 4]])
+    assert make_ndcg_at_k_loss_np(k=2)(y_true, y_pred) == approx(
+        make_ndcg_at_k_loss_np(k=2, ignore_ties=False)(y_true, y_pred), rel=1e-5
+    )
+
+
+@pytest.mark.parametrize(
+    "y_true",
+    [[[0, 1, 2, 3, 4]], [[-1, 0, 1, 2, 3]], [[0.5, 1.5, 2.5, 3.5, 4.5]]],
+    ids=["Integers", "Negative", "Fractional"],
+)
+def test_ndcg_np_any_ranks(y_true):
+    y_true = np.array(y_true)
+    y_pred = np.array([[0, 2, 1, 3, 4]])
+    relevance = 2.0 ** ((5 - y_true[0]) * 60 / 5) - 1
+    idcg = relevance[0] / np.log2(2) + relevance[1] / np.log2(3)
+    dcg = relevance[0] / np.log2(2) + relevance[2] / np.log2(3)
+
+    ndcg = make_ndcg_at_k_loss_np(k=2)
+    assert ndcg(y_true, y_pred)[0] == approx(dcg / idcg, rel=1e-5)
+
+
 def test_kendalls_tau_for_scores(problem_for_scores):
     y_true, y_pred, ties = problem_for_scores
 
@@ -257,6 +352,17 @@ def test_err_against_manually_verified_example():
     assert K.eval(err(y_true, y_pred)) == approx(17 / 32)
 
 
+def test_err_np_custom_probability_mapping():
+    """Custom mappings receive the original (integer) grades."""
+    y_true = ranking_ordering_conversion([[1, 2, 0]])
+    y_pred = ranking_ordering_conversion([[2, 1, 0]])
+    # The relevance gain probabilities of the grades 0, 1 and 2, see
+    # test_err_against_manually_verified_example
+    probabilities = [3 / 4, 1 / 4, 0]
+    result = err_np(y_true, y_pred, probability_mapping=lambda g: probabilities[g])
+    assert result == approx(17 / 32)
+
+
 def test_err_implementations_equivalent():
     """Spot-checks equivalence of plain python and tf implementations"""
     # A simple grading where each grade occurs once. We want to check
@@ -37,8 +37,8 @@ if __name__ == "__main__":
         description=DESCRIPTION,
         packages=find_packages(),
         install_requires=[
-            "numpy>=1.12.1",
-            "scipy>=0.19.0",
+            "numpy>=1.15.0",
+            "scipy>=1.4.0",
             "scikit-learn>=0.18.2",
             "scikit-optimize>=0.4",
             "pandas>=0.22",